@@ -0,0 +1,536 @@
+import atexit
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import queue
+import re
+import threading
+import time
+
+# =========================
+# REACT audit log
+# Append-only record of every evaluation (inputs, normalized values,
+# rule-pack version, detected issues, guidance shown).
+# The Analyze path only enqueues; a background thread serializes, writes,
+# fsyncs in batches, rotates by size and gzip-compresses sealed segments.
+# =========================
+
+ACTIVE_NAME = "audit.jsonl"
+TORN_NAME = "audit.torn"
+LOCK_NAME = "audit.lock"
+PATIENTS_DIR = "audit.patients"
+SEGMENT_RE = re.compile(r"^audit\.(\d{6})\.jsonl\.gz$")
+SEALING_RE = re.compile(r"^audit\.(\d{6})\.jsonl\.sealing$")
+
+_STOP = object()
+
+
+class AuditLogError(RuntimeError):
+    """Raised when the log is unavailable; the record was not written."""
+
+
+class AuditRecordsLost(AuditLogError):
+    """Raised by record() after queuing its entry when earlier ones were lost."""
+
+
+def _segment_name(seq: int):
+    return f"audit.{seq:06d}.jsonl.gz"
+
+
+def _sealing_name(seq: int):
+    return f"audit.{seq:06d}.jsonl.sealing"
+
+
+def _index_name(segment_name: str):
+    return segment_name + ".idx.json"
+
+
+def _bucket_name(patient_id: str):
+    """Patient -> segments lookups are split into 256 hashed bucket files."""
+    return hashlib.sha1(patient_id.encode("utf-8")).hexdigest()[:2] + ".jsonl"
+
+
+def _encode(entry):
+    try:
+        return (json.dumps(entry, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+    except (TypeError, ValueError) as exc:
+        fallback = {"patient_id": entry.get("patient_id"), "unserializable": repr(entry), "error": repr(exc)}
+        return (json.dumps(fallback, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+
+
+def _fsync_path(path):
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+
+
+def _acquire_lock(path):
+    """Exclusive, non-blocking flock; one writer per audit directory."""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        raise AuditLogError(f"another audit writer holds {path}") from None
+    return fd
+
+
+def _truncate_torn_tail(path, torn_path):
+    """
+    Cut a crash-torn final line back to the last newline so the next record
+    starts on its own line. The fragment is kept in `torn_path`, not dropped.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, "r+b") as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        while pos > 0:
+            step = min(64 * 1024, pos)
+            f.seek(pos - step)
+            nl = f.read(step).rfind(b"\n")
+            if nl != -1:
+                pos = pos - step + nl + 1
+                break
+            pos -= step
+        if pos == end:
+            return
+        f.seek(pos)
+        fragment = f.read()
+        with open(torn_path, "ab") as t:
+            t.write(fragment + b"\n")
+            t.flush()
+            os.fsync(t.fileno())
+        f.truncate(pos)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+# -------------------------
+# Writer
+# -------------------------
+class AuditLog:
+    """
+    Buffered append-only audit log.
+
+    record() only stamps the entry and puts it on a bounded queue; when the
+    queue is full the caller blocks (backpressure) rather than dropping a
+    record. The writer thread drains up to `batch_size` entries at a time,
+    writes them as JSON lines and issues one fsync per batch. A batch that
+    fails to write is retried with backoff, then spilled to `audit.torn`;
+    only if that also fails is it lost, and the next record() call says so.
+
+    When the active file reaches `max_bytes` it is renamed to a numbered
+    `.sealing` file, then compressed into a gzip segment alongside a line
+    index (patient_id -> offsets) and entries in hashed per-patient bucket
+    files (patient_id -> segment numbers). Opening the log takes an
+    exclusive lock on the directory, finishes any rotation a crash
+    interrupted and trims a torn final line.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 64 * 1024 * 1024,
+                 queue_size: int = 10000, batch_size: int = 256,
+                 flush_interval: float = 1.0, write_retries: int = 5,
+                 retry_delay: float = 0.1):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.write_retries = write_retries
+        self.retry_delay = retry_delay
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock_fd = _acquire_lock(os.path.join(directory, LOCK_NAME))
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._closed = False
+        self._lost = 0
+        self._last_failure = None
+        self._lost_lock = threading.Lock()
+        self._active_path = os.path.join(directory, ACTIVE_NAME)
+        self._torn_path = os.path.join(directory, TORN_NAME)
+        self._fh = None
+        self._index = {}
+        try:
+            self._next_seq = self._last_segment_seq() + 1
+            self._seal_pending()
+            _truncate_torn_tail(self._active_path, self._torn_path)
+            self._open_active()
+            self._index = self._scan_index(self._active_path) if self._size else {}
+        except BaseException:
+            os.close(self._lock_fd)
+            raise
+
+        self._thread = threading.Thread(target=self._run, name="react-audit-writer", daemon=True)
+        self._thread.start()
+
+    def healthy(self):
+        """True while the writer thread is running and accepting records."""
+        return not self._closed and self._thread.is_alive()
+
+    def record(self, entry: dict, timeout: float = None):
+        """
+        Enqueue one evaluation. Blocks while the queue is full; raises
+        AuditLogError if `timeout` expires or the log is unavailable. If
+        earlier records were lost, this one is still queued and then
+        AuditRecordsLost reports the loss. The caller must not mutate `entry`.
+        """
+        if not self.healthy():
+            raise AuditLogError("audit log is closed")
+        entry.setdefault("ts", time.time())
+        if entry.get("patient_id") is not None:
+            entry["patient_id"] = str(entry["patient_id"])
+        try:
+            self._queue.put(entry, block=True, timeout=timeout)
+        except queue.Full:
+            raise AuditLogError("audit queue full; record not written") from None
+
+        with self._lost_lock:
+            lost, self._lost = self._lost, 0
+        if lost:
+            raise AuditRecordsLost(
+                f"{lost} earlier audit record(s) could not be written ({self._last_failure!r}); "
+                "this evaluation was queued"
+            )
+
+    def close(self, timeout: float = 5.0):
+        """Flush everything queued so far and stop the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        if not self._thread.is_alive():
+            return  # writer already stopped; nothing will drain the queue
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    # Writer thread --------------------------------------------------------
+    def _run(self):
+        try:
+            while True:
+                batch = [self._queue.get()]
+                deadline = time.monotonic() + self.flush_interval
+                while len(batch) < self.batch_size and batch[-1] is not _STOP:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(self._queue.get(timeout=remaining))
+                    except queue.Empty:
+                        break
+
+                stop = batch[-1] is _STOP
+                entries = batch[:-1] if stop else batch
+                if entries:
+                    lines = [_encode(e) for e in entries]
+                    try:
+                        self._write_batch(entries, lines)
+                    except Exception as exc:  # never let the writer die with records in hand
+                        self._last_failure = exc
+                        self._spill(lines)
+                if stop:
+                    break
+        finally:
+            try:
+                if self._fh is not None:
+                    self._fh.close()
+            except OSError:
+                pass
+            os.close(self._lock_fd)
+
+    def _write_batch(self, entries, lines):
+        delay = self.retry_delay
+        for attempt in range(self.write_retries + 1):
+            try:
+                self._append(entries, lines)
+                break
+            except OSError as exc:
+                self._last_failure = exc
+                self._reset_active()
+                if attempt == self.write_retries:
+                    self._spill(lines)
+                    return
+                time.sleep(delay)
+                delay = min(delay * 2, 5.0)
+
+        if self._size >= self.max_bytes:
+            try:
+                self._rotate()
+            except OSError as exc:
+                # Records are already durable; rotation is retried next batch.
+                self._last_failure = exc
+                if self._fh is None:
+                    self._reset_active()
+
+    def _append(self, entries, lines):
+        if self._fh is None:
+            self._open_active()
+        offsets = []
+        for entry, line in zip(entries, lines):
+            pid = entry.get("patient_id")
+            if pid:
+                offsets.append((str(pid), self._fh.tell()))
+            self._fh.write(line)
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+
+        for pid, off in offsets:
+            self._index.setdefault(pid, []).append(off)
+        self._size = self._fh.tell()
+
+    def _open_active(self):
+        self._fh = open(self._active_path, "ab")
+        self._size = self._fh.tell()
+
+    def _reset_active(self):
+        """After a failed write: drop the partial batch and reopen."""
+        committed = self._size
+        try:
+            if self._fh is not None:
+                self._fh.close()
+        except OSError:
+            pass
+        self._fh = None
+        try:
+            if os.path.exists(self._active_path) and os.path.getsize(self._active_path) > committed:
+                os.truncate(self._active_path, committed)
+            self._open_active()
+            if self._size != committed:
+                self._index = self._scan_index(self._active_path)
+        except OSError:
+            self._fh = None  # next attempt reopens
+            self._size = committed
+
+    def _spill(self, lines):
+        try:
+            with open(self._torn_path, "ab") as f:
+                f.write(b"".join(lines))
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception as exc:
+            with self._lost_lock:
+                self._lost += len(lines)
+            self._last_failure = exc
+
+    def _rotate(self):
+        self._fh.close()
+        self._fh = None
+        # The rename is the commit point: from here the records live only in
+        # the .sealing file (readable as-is), so a crash or error at any later
+        # step is finished by _seal_pending() without sealing them twice.
+        seq = self._next_seq
+        os.replace(self._active_path, os.path.join(self.directory, _sealing_name(seq)))
+        self._next_seq += 1
+        index, self._index = self._index, {}
+        self._open_active()
+        self._seal(seq, index)
+        self._seal_pending()
+
+    def _seal_pending(self):
+        for name in sorted(os.listdir(self.directory)):
+            m = SEALING_RE.match(name)
+            if m:
+                self._seal(int(m.group(1)))
+
+    def _seal(self, seq, index=None):
+        """Compress sealing file `seq` into its segment + indexes; idempotent."""
+        sealing_path = os.path.join(self.directory, _sealing_name(seq))
+        seg_name = _segment_name(seq)
+        seg_path = os.path.join(self.directory, seg_name)
+
+        if not os.path.exists(seg_path):
+            if index is None:
+                index = self._scan_index(sealing_path)
+            tmp_path = seg_path + ".tmp"
+            with open(sealing_path, "rb") as src, gzip.open(tmp_path, "wb") as dst:
+                while True:
+                    chunk = src.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+            _fsync_path(tmp_path)
+
+            idx_path = os.path.join(self.directory, _index_name(seg_name))
+            with open(idx_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(index, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(idx_path + ".tmp", idx_path)
+            self._add_to_patient_buckets(seq, index)
+
+            # Segment becomes visible only once its indexes exist.
+            os.replace(tmp_path, seg_path)
+
+        os.remove(sealing_path)
+
+    def _add_to_patient_buckets(self, seq, patients):
+        """Append (patient, seq) pairs; a re-run after a crash only adds duplicates."""
+        by_bucket = {}
+        for pid in patients:
+            by_bucket.setdefault(_bucket_name(pid), []).append(pid)
+
+        bucket_dir = os.path.join(self.directory, PATIENTS_DIR)
+        os.makedirs(bucket_dir, exist_ok=True)
+        for name, pids in by_bucket.items():
+            path = os.path.join(bucket_dir, name)
+            _truncate_torn_tail(path, self._torn_path)
+            data = "".join(json.dumps({"p": pid, "seq": seq}, ensure_ascii=False) + "\n" for pid in pids)
+            with open(path, "ab") as f:
+                f.write(data.encode("utf-8"))
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _last_segment_seq(self):
+        seqs = [int(m.group(1)) for n in os.listdir(self.directory)
+                for m in (SEGMENT_RE.match(n) or SEALING_RE.match(n),) if m]
+        return max(seqs) if seqs else 0
+
+    @staticmethod
+    def _scan_index(path):
+        index = {}
+        offset = 0
+        with open(path, "rb") as f:
+            for line in f:
+                pid = _patient_of(line)
+                if pid:
+                    index.setdefault(pid, []).append(offset)
+                offset += len(line)
+        return index
+
+
+# -------------------------
+# Shared instance
+# -------------------------
+_shared = {}
+_shared_lock = threading.Lock()
+
+def shared_log(directory: str, **kwargs):
+    """
+    Process-wide AuditLog for `directory`, replaced if its writer has
+    stopped. Kept at module level so it outlives Streamlit reruns and
+    cache clears, which would otherwise start a second writer.
+    """
+    key = os.path.realpath(directory)
+    with _shared_lock:
+        log = _shared.get(key)
+        if log is None or not log.healthy():
+            if log is not None:
+                log.close(1.0)
+            log = AuditLog(directory, **kwargs)
+            atexit.register(log.close)  # drain the queue on server shutdown
+            _shared[key] = log
+        return log
+
+
+# -------------------------
+# Reader
+# -------------------------
+def _patient_of(line: bytes):
+    try:
+        pid = json.loads(line).get("patient_id")
+    except (ValueError, AttributeError):
+        return None
+    return str(pid) if pid else None
+
+
+def _record_for(line: bytes, pid: str):
+    """Parse `line` if it is a complete record for `pid`, else None."""
+    try:
+        rec = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(rec, dict) or str(rec.get("patient_id")) != pid:
+        return None
+    return rec
+
+
+class AuditReader:
+    """
+    Read-only access to an audit directory. patient_history() re-reads if
+    the writer rotates while it is reading, so no batch is skipped, and
+    reads rotations left unfinished by a failed writer directly.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def segments(self):
+        """Sealed segment names, oldest first."""
+        names = [n for n in os.listdir(self.directory) if SEGMENT_RE.match(n)]
+        return sorted(names)
+
+    def patient_history(self, patient_id, retries: int = 20):
+        """All records for one patient, oldest first (by `ts`)."""
+        pid = str(patient_id)
+        for _ in range(retries):
+            before = self._rotation_state()
+            out = self._read_history(pid, before)
+            if self._rotation_state() == before:
+                return sorted(out, key=lambda r: r.get("ts", 0))
+            time.sleep(0.01)
+        raise AuditLogError("audit log kept rotating during read; try again")
+
+    def _rotation_state(self):
+        return sorted(n for n in os.listdir(self.directory) if SEGMENT_RE.match(n) or SEALING_RE.match(n))
+
+    def _segments_for(self, pid):
+        path = os.path.join(self.directory, PATIENTS_DIR, _bucket_name(pid))
+        seqs = set()
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        e = json.loads(line)
+                    except ValueError:
+                        continue
+                    if e.get("p") == pid:
+                        seqs.add(e["seq"])
+        return seqs
+
+    def _read_history(self, pid, state):
+        segments = {int(m.group(1)): n for n in state for m in (SEGMENT_RE.match(n),) if m}
+        sealing = {int(m.group(1)): n for n in state for m in (SEALING_RE.match(n),) if m}
+        wanted = self._segments_for(pid)
+
+        out = []
+        for seq in sorted(set(segments) | set(sealing)):
+            if seq in segments:
+                if seq in wanted:
+                    out.extend(self._read_segment(pid, segments[seq]))
+            else:
+                out.extend(self._scan(pid, os.path.join(self.directory, sealing[seq])))
+        out.extend(self._scan(pid, os.path.join(self.directory, ACTIVE_NAME)))
+        out.extend(self._scan(pid, os.path.join(self.directory, TORN_NAME)))
+        return out
+
+    def _read_segment(self, pid, seg_name):
+        with open(os.path.join(self.directory, _index_name(seg_name)), encoding="utf-8") as f:
+            offsets = json.load(f).get(pid) or []
+        out = []
+        # Offsets are ascending, so gzip only ever seeks forward. An offset
+        # that lands on another patient's line is ignored, not returned.
+        with gzip.open(os.path.join(self.directory, seg_name), "rb") as g:
+            for off in offsets:
+                g.seek(off)
+                rec = _record_for(g.readline(), pid)
+                if rec is not None:
+                    out.append(rec)
+        return out
+
+    def _scan(self, pid, path):
+        """Plain JSONL scan (active, sealing and spill files)."""
+        needle = json.dumps(pid, ensure_ascii=False).encode("utf-8")
+        out = []
+        if not os.path.exists(path):
+            return out
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # partial write in progress
+                if needle in line:
+                    rec = _record_for(line, pid)
+                    if rec is not None:
+                        out.append(rec)
+        return out
@@ -0,0 +1,182 @@
+import sys
+import warnings
+
+import numpy as np
+import pandas as pd
+
+# =========================
+# REACT derived-value engine
+# Fills in computed inputs column-wise before grading:
+#   - Cockcroft-Gault CLcr (baseline + current) from creatinine, age, weight, sex
+#   - % change in creatinine and CLcr from baseline
+#   - ULN multiples for creatinine and bilirubin, and the creatinine multiple
+#     CTCAE grades on (vs ULN, or vs baseline when baseline > ULN)
+# Works on any column mapping: a dict of arrays (single patient = length 1)
+# or a pandas DataFrame (batch). Missing or non-numeric values (e.g. "<0.2")
+# are NaN throughout, matching parse_float in the UI.
+# =========================
+
+# Column names shared by the UI and batch feeds.
+INPUT_COLUMNS = [
+    "baseline_cr", "current_cr", "uln_cr",
+    "baseline_clcr", "current_clcr",
+    "bilirubin", "uln_bilirubin",
+    "age", "weight_kg", "sex",
+]
+# Plausible adult range for Cockcroft-Gault; outside it CLcr is not computed.
+CG_MIN_AGE = 18
+CG_MAX_AGE = 120
+
+DERIVED_COLUMNS = [
+    "baseline_clcr", "current_clcr",
+    "baseline_clcr_estimated", "current_clcr_estimated",
+    "cr_pct_change", "clcr_pct_change",
+    "cr_uln_multiple", "bilirubin_uln_multiple",
+    "cr_grading_multiple", "cr_graded_vs_baseline",
+]
+
+# -------------------------
+# Vectorized formulas (NaN in -> NaN out)
+# -------------------------
+def _float_array(values, n):
+    if values is None:
+        return np.full(n, np.nan)
+    arr = np.asarray(pd.to_numeric(values, errors="coerce"), dtype=float)
+    return np.broadcast_to(arr, (n,)) if arr.ndim == 0 else arr
+
+def female_mask(sex):
+    """
+    Map sex labels to 1.0 (female), 0.0 (male), NaN (unknown).
+    Accepts "F"/"Female"/"M"/"Male" in any case.
+    """
+    # Feeds carry a handful of distinct labels; classify those, then scatter.
+    labels, inverse = np.unique(np.asarray(sex, dtype=str), return_inverse=True)
+    s = np.char.lower(np.char.strip(labels))
+    per_label = np.where(np.char.startswith(s, "f"), 1.0,
+                         np.where(np.char.startswith(s, "m"), 0.0, np.nan))
+    return per_label[inverse.reshape(-1)]
+
+def cockcroft_gault(creatinine_mg_dl, age, weight_kg, female):
+    """
+    CLcr (mL/min) = (140 - age) * weight / (72 * SCr), x 0.85 if female.
+    Uses actual body weight. NaN when creatinine or weight is non-positive,
+    age is outside CG_MIN_AGE..CG_MAX_AGE, or the result is non-positive.
+    """
+    cr = np.asarray(creatinine_mg_dl, dtype=float)
+    age = np.asarray(age, dtype=float)
+    weight_kg = np.asarray(weight_kg, dtype=float)
+    female = np.asarray(female, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        clcr = (140.0 - age) * weight_kg / (72.0 * cr)
+        clcr = clcr * np.where(female == 1.0, 0.85, 1.0)
+    valid = (cr > 0) & (weight_kg > 0) & (age >= CG_MIN_AGE) & (age <= CG_MAX_AGE) & ~np.isnan(female)
+    clcr[~valid | ~(clcr > 0)] = np.nan
+    return clcr
+
+# Percentages and multiples are rounded so values entered exactly on a
+# threshold (1.0 -> 1.4 mg/dL is +40%) compare as exactly on it.
+ROUND_DECIMALS = 9
+
+def pct_change(baseline, current):
+    """Signed % change from baseline; non-positive baseline -> NaN."""
+    baseline = np.asarray(baseline, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        out = (np.asarray(current, dtype=float) - baseline) / baseline * 100.0
+    out[~(baseline > 0)] = np.nan
+    return np.round(out, ROUND_DECIMALS)
+
+def uln_multiple(value, uln):
+    """value / ULN; non-positive ULN -> NaN."""
+    uln = np.asarray(uln, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        out = np.asarray(value, dtype=float) / uln
+    out[~(uln > 0)] = np.nan
+    return np.round(out, ROUND_DECIMALS)
+
+# -------------------------
+# Engine
+# -------------------------
+def derive_inputs(cols):
+    """
+    Fill derived columns in place and return `cols`.
+
+    Entered CLcr always wins: Cockcroft-Gault only fills rows where
+    baseline/current CLcr is missing (flagged in *_clcr_estimated). Baseline
+    CLcr uses the same age and weight as current. clcr_pct_change is only
+    computed when both sides are measured or both are estimated, so a
+    method mismatch cannot fire a CLcr-decrease trigger. Absent input
+    columns are treated as all-missing.
+    """
+    n = len(cols[next(iter(cols))])
+    col = {k: _float_array(cols[k] if k in cols else None, n) for k in INPUT_COLUMNS if k != "sex"}
+    female = female_mask(cols["sex"]) if "sex" in cols else np.full(n, np.nan)
+
+    estimated = {}
+    for which in ("baseline", "current"):
+        entered = col[f"{which}_clcr"]
+        computed = cockcroft_gault(col[f"{which}_cr"], col["age"], col["weight_kg"], female)
+        estimated[which] = np.isnan(entered) & ~np.isnan(computed)
+        col[f"{which}_clcr"] = np.where(np.isnan(entered), computed, entered)
+
+    clcr_pct = pct_change(col["baseline_clcr"], col["current_clcr"])
+    clcr_pct[estimated["baseline"] != estimated["current"]] = np.nan
+
+    # CTCAE "Creatinine increased": multiple of ULN, or of baseline when baseline > ULN.
+    uln_ok = col["uln_cr"] > 0
+    vs_baseline = uln_ok & (col["baseline_cr"] > col["uln_cr"])
+    grading = uln_multiple(col["current_cr"], np.where(vs_baseline, col["baseline_cr"], col["uln_cr"]))
+    grading[~uln_ok] = np.nan
+
+    cols["baseline_clcr"] = col["baseline_clcr"]
+    cols["current_clcr"] = col["current_clcr"]
+    cols["baseline_clcr_estimated"] = estimated["baseline"]
+    cols["current_clcr_estimated"] = estimated["current"]
+    cols["cr_pct_change"] = pct_change(col["baseline_cr"], col["current_cr"])
+    cols["clcr_pct_change"] = clcr_pct
+    cols["cr_uln_multiple"] = uln_multiple(col["current_cr"], col["uln_cr"])
+    cols["bilirubin_uln_multiple"] = uln_multiple(col["bilirubin"], col["uln_bilirubin"])
+    cols["cr_grading_multiple"] = grading
+    cols["cr_graded_vs_baseline"] = vs_baseline
+    return cols
+
+def check_sex_labels(sex):
+    """
+    Raise ValueError if no non-blank label in `sex` is recognised (e.g. a
+    feed coded 1/2), since Cockcroft-Gault would silently be skipped for
+    every row. Returns the unrecognised labels when only some are.
+    """
+    labels = pd.unique(pd.Series(sex).dropna().astype(str).str.strip())
+    labels = labels[labels != ""]
+    if len(labels) == 0:
+        return []
+    unknown = labels[np.isnan(female_mask(labels))]
+    if len(unknown) == len(labels):
+        raise ValueError(
+            f"sex column has no recognised values (saw {sorted(unknown)[:10]}); "
+            "expected F/Female/M/Male"
+        )
+    return sorted(unknown)
+
+def enrich_csv(src, dst, chunksize=500_000):
+    """
+    Batch path: stream a lab-feed CSV through derive_inputs in chunks.
+    Raises ValueError on a sex column with no recognised labels; warns
+    about labels it does not recognise (CLcr is not estimated for them).
+    """
+    header = True
+    unknown = set()
+    for chunk in pd.read_csv(src, chunksize=chunksize):
+        if "sex" in chunk:
+            unknown.update(check_sex_labels(chunk["sex"]))
+        derive_inputs(chunk).to_csv(dst, mode="w" if header else "a", header=header, index=False)
+        header = False
+    if unknown:
+        warnings.warn(f"unrecognised sex labels {sorted(unknown)[:10]}; CLcr not estimated for those rows")
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("usage: python derived_values.py INPUT.csv OUTPUT.csv")
+    try:
+        enrich_csv(sys.argv[1], sys.argv[2])
+    except ValueError as e:
+        sys.exit(f"error: {e}")
@@ -1,6 +1,13 @@
+import hashlib
+import json
+import math
+import os
 import re
 import streamlit as st
 
+from audit_log import AuditLogError, AuditRecordsLost, shared_log
+from derived_values import derive_inputs
+
 # =========================
 # REACT: Radionuclide Therapy Toxicity Tool
 # CTCAE v5.0 grading + FDA label-inspired dose-mod guidance
@@ -44,6 +51,11 @@ def parse_float(text: str):
     except ValueError:
         return None
 
+def nan_to_none(x):
+    """Derived-value arrays use NaN for missing; UI/assessments use None."""
+    x = float(x)
+    return None if math.isnan(x) else x
+
 def normalize_grade_string(s: str):
     """
     Extract (op, n) from strings like:
@@ -207,22 +219,13 @@ def determine_ctcae_grade(parameter: str, value):
             return g
     return None
 
-def ctcae_creatinine_increase_grade(baseline_cr, current_cr, uln_cr):
+def ctcae_creatinine_increase_grade(ratio):
     """
-    Numeric implementation of CTCAE-like "Creatinine increased":
-      - If baseline <= ULN (or unknown): grade by multiple of ULN
-      - If baseline > ULN: grade by multiple of baseline
+    Numeric implementation of CTCAE-like "Creatinine increased".
+    `ratio` is derive_inputs' cr_grading_multiple:
+      - If baseline <= ULN (or unknown): multiple of ULN
+      - If baseline > ULN: multiple of baseline
     """
-    if current_cr is None or uln_cr is None or uln_cr <= 0:
-        return None
-    base = baseline_cr if baseline_cr is not None else None
-
-    if base is None or base <= uln_cr:
-        ref = uln_cr
-    else:
-        ref = base
-
-    ratio = current_cr / ref if ref > 0 else None
     if ratio is None:
         return None
 
@@ -306,25 +309,37 @@ dose_modifications = {
     },
 }
 
+# Content hash of the grading + guidance tables; recorded with every audited evaluation.
+RULE_PACK_VERSION = hashlib.sha256(
+    json.dumps([ctcae_criteria, dose_modifications], sort_keys=True, ensure_ascii=False).encode("utf-8")
+).hexdigest()[:12]
+
+# -------------------------
+# Audit log (one writer thread per server process)
+# -------------------------
+AUDIT_DIR = os.environ.get("REACT_AUDIT_DIR", "audit_logs")
+
+def get_audit_log():
+    """Shared writer; a writer that has stopped is replaced on the next call."""
+    return shared_log(AUDIT_DIR)
+
 # -------------------------
 # Toxicity assessment functions
 # -------------------------
-def assess_lutathera_renal(baseline_cr, current_cr, baseline_clcr, current_clcr):
+# % changes and ULN multiples come from derive_inputs (derived_values.py).
+def assess_lutathera_renal(current_clcr, cr_pct_change, clcr_pct_change):
     issues = []
     if current_clcr is not None and current_clcr < 40:
         issues.append("CLcr < 40 mL/min")
-    if baseline_cr is not None and current_cr is not None and baseline_cr > 0:
-        if (current_cr / baseline_cr) >= 1.4:
-            issues.append("≥40% increase from baseline creatinine")
-    if baseline_clcr is not None and current_clcr is not None and baseline_clcr > 0:
-        frac_decrease = (baseline_clcr - current_clcr) / baseline_clcr
-        if frac_decrease >= 0.40:
-            issues.append("≥40% decrease from baseline CLcr")
+    if cr_pct_change is not None and cr_pct_change >= 40:
+        issues.append("≥40% increase from baseline creatinine")
+    if clcr_pct_change is not None and clcr_pct_change <= -40:
+        issues.append("≥40% decrease from baseline CLcr")
     return issues
 
-def assess_pluvicto_renal(baseline_cr, current_cr, uln_cr, baseline_clcr, current_clcr):
+def assess_pluvicto_renal(cr_grading_multiple, current_clcr, cr_pct_change, clcr_pct_change):
     issues = []
-    cr_grade = ctcae_creatinine_increase_grade(baseline_cr, current_cr, uln_cr)
+    cr_grade = ctcae_creatinine_increase_grade(cr_grading_multiple)
     _, n = normalize_grade_string(cr_grade) if cr_grade else (None, None)
 
     # Hold triggers
@@ -334,13 +349,9 @@ def assess_pluvicto_renal(baseline_cr, current_cr, uln_cr, baseline_clcr, curren
         issues.append("Confirmed creatinine Grade ≥ 2 OR CLcr < 30")
 
     # Dose reduction combo trigger
-    if baseline_cr is not None and current_cr is not None and baseline_cr > 0:
-        cr_increase = current_cr / baseline_cr
-        if cr_increase >= 1.4:
-            if baseline_clcr is not None and current_clcr is not None and baseline_clcr > 0:
-                clcr_decrease = (baseline_clcr - current_clcr) / baseline_clcr
-                if clcr_decrease > 0.40:
-                    issues.append("≥40% creatinine increase AND >40% CLcr decrease")
+    if cr_pct_change is not None and cr_pct_change >= 40:
+        if clcr_pct_change is not None and clcr_pct_change < -40:
+            issues.append("≥40% creatinine increase AND >40% CLcr decrease")
 
     # Discontinue trigger (renal Grade ≥ 3)
     if n is not None and n >= 3:
@@ -348,11 +359,10 @@ def assess_pluvicto_renal(baseline_cr, current_cr, uln_cr, baseline_clcr, curren
 
     return issues, cr_grade
 
-def assess_lutathera_hepatic(bilirubin, uln_bilirubin, albumin_g_l, inr):
+def assess_lutathera_hepatic(bilirubin_uln_multiple, albumin_g_l, inr):
     issues = []
-    if bilirubin is not None and uln_bilirubin is not None and uln_bilirubin > 0:
-        if bilirubin > 3.0 * uln_bilirubin:
-            issues.append("Bilirubin > 3x ULN")
+    if bilirubin_uln_multiple is not None and bilirubin_uln_multiple > 3.0:
+        issues.append("Bilirubin > 3x ULN")
     if albumin_g_l is not None and inr is not None:
         if albumin_g_l < 30 and inr > 1.5:
             issues.append("Albumin < 30 g/L with INR > 1.5")
@@ -369,6 +379,7 @@ st.title("🩺 REACT: Radiotheranostic Evaluation & Assessment for Clinical Toxi
 st.markdown("**CTCAE v5.0 grading + FDA label-inspired dose modification guidance (educational)**")
 
 drug = st.selectbox("**Select Radionuclide Therapy**", options=["LUTATHERA", "PLUVICTO"], key="drug_selection")
+patient_id_txt = st.text_input("Patient ID (for audit log)", value="", placeholder="e.g., MRN or study ID")
 
 st.markdown("---")
 st.subheader("🧮 Input Units (so entries match typical workflow)")
@@ -415,8 +426,16 @@ with colB:
     baseline_cr_txt = st.text_input("Baseline Creatinine (mg/dL)", value="", placeholder="e.g., 1.0")
     current_cr_txt = st.text_input("Current Creatinine (mg/dL)", value="", placeholder="e.g., 1.5")
     uln_cr_txt = st.text_input("ULN Creatinine (mg/dL)", value="1.2", placeholder="e.g., 1.2")
-    baseline_clcr_txt = st.text_input("Baseline Creatinine Clearance (mL/min)", value="", placeholder="e.g., 85")
-    current_clcr_txt = st.text_input("Current Creatinine Clearance (mL/min)", value="", placeholder="e.g., 55")
+    baseline_clcr_txt = st.text_input("Baseline Creatinine Clearance (mL/min)", value="", placeholder="blank = Cockcroft-Gault")
+    current_clcr_txt = st.text_input("Current Creatinine Clearance (mL/min)", value="", placeholder="blank = Cockcroft-Gault")
+    colR1, colR2, colR3 = st.columns(3)
+    with colR1:
+        age_txt = st.text_input("Age (years)", value="", placeholder="e.g., 65")
+    with colR2:
+        weight_txt = st.text_input("Weight (kg)", value="", placeholder="e.g., 70")
+    with colR3:
+        sex = st.selectbox("Sex", options=["", "Female", "Male"], index=0)
+    st.caption("Blank CLcr fields are computed by Cockcroft-Gault from creatinine, age, weight and sex.")
 
 st.markdown("### Hepatic")
 colH1, colH2 = st.columns(2)
@@ -471,6 +490,31 @@ if st.button("🔍 **Analyze Laboratory Values**", type="primary"):
     uln_bilirubin = parse_float(uln_bili_txt)
     albumin = parse_float(alb_txt)
     inr = parse_float(inr_txt)
+    age = parse_float(age_txt)
+    weight_kg = parse_float(weight_txt)
+
+    # Derived values (same engine as batch feeds; one-row columns here)
+    derived = derive_inputs({
+        "baseline_cr": [baseline_creatinine], "current_cr": [current_creatinine], "uln_cr": [uln_creatinine],
+        "baseline_clcr": [baseline_clcr], "current_clcr": [current_clcr],
+        "bilirubin": [bilirubin], "uln_bilirubin": [uln_bilirubin],
+        "age": [age], "weight_kg": [weight_kg], "sex": [sex],
+    })
+    clcr_computed = []
+    if derived["baseline_clcr_estimated"][0]:
+        clcr_computed.append("Baseline")
+    if derived["current_clcr_estimated"][0]:
+        clcr_computed.append("Current")
+    baseline_clcr = nan_to_none(derived["baseline_clcr"][0])
+    current_clcr = nan_to_none(derived["current_clcr"][0])
+    cr_pct_change = nan_to_none(derived["cr_pct_change"][0])
+    clcr_pct_change = nan_to_none(derived["clcr_pct_change"][0])
+    cr_uln_multiple = nan_to_none(derived["cr_uln_multiple"][0])
+    bilirubin_uln_multiple = nan_to_none(derived["bilirubin_uln_multiple"][0])
+    cr_grading_multiple = nan_to_none(derived["cr_grading_multiple"][0])
+    cr_grading_ref = "baseline" if derived["cr_graded_vs_baseline"][0] else "ULN"
+    # Measured vs estimated CLcr are not compared (no clcr_pct_change then).
+    clcr_mixed_source = (baseline_clcr is not None and current_clcr is not None and len(clcr_computed) == 1)
 
     # Normalize CBC values to /uL for CTCAE grading
     hemoglobin = hgb_in  # g/dL stays the same
@@ -533,22 +577,28 @@ if st.button("🔍 **Analyze Laboratory Values**", type="primary"):
 
     # Renal assessment
     cr_ctcae_grade = None
+    # CLcr-threshold triggers note when current CLcr is a Cockcroft-Gault estimate
+    clcr_note = None
+    if "Current" in clcr_computed:
+        clcr_note = f"Current CLcr {current_clcr:.0f} mL/min is a Cockcroft-Gault estimate"
+
     if drug == "LUTATHERA":
-        renal_issues = assess_lutathera_renal(
-            baseline_creatinine, current_creatinine, baseline_clcr, current_clcr
-        )
+        renal_issues = assess_lutathera_renal(current_clcr, cr_pct_change, clcr_pct_change)
         for issue in renal_issues:
-            detected_issues.append(("Renal Toxicity", issue, None))
+            detected_issues.append(("Renal Toxicity", issue, clcr_note if "CLcr <" in issue else None))
 
     if drug == "PLUVICTO":
         renal_issues, cr_ctcae_grade = assess_pluvicto_renal(
-            baseline_creatinine, current_creatinine, uln_creatinine, baseline_clcr, current_clcr
+            cr_grading_multiple, current_clcr, cr_pct_change, clcr_pct_change
         )
         for issue in renal_issues:
-            detected_issues.append(("Renal Toxicity", issue, cr_ctcae_grade))
+            detail = cr_ctcae_grade
+            if clcr_note and "CLcr <" in issue:
+                detail = f"{clcr_note}; creatinine {cr_ctcae_grade}" if cr_ctcae_grade else clcr_note
+            detected_issues.append(("Renal Toxicity", issue, detail))
 
     # Hepatic assessment (used primarily for LUTATHERA triggers included in this tool)
-    hepatic_issues = assess_lutathera_hepatic(bilirubin, uln_bilirubin, albumin, inr)
+    hepatic_issues = assess_lutathera_hepatic(bilirubin_uln_multiple, albumin, inr)
     for issue in hepatic_issues:
         detected_issues.append(("Hepatotoxicity", issue, None))
 
@@ -620,24 +670,43 @@ if st.button("🔍 **Analyze Laboratory Values**", type="primary"):
                 st.markdown(f"• WBC interpreted as **{int(round(wbc)):,} /uL**")
             if anc is not None:
                 st.markdown(f"• ANC interpreted as **{int(round(anc)):,} /uL**")
+            for which in clcr_computed:
+                v = baseline_clcr if which == "Baseline" else current_clcr
+                st.markdown(f"• {which} CLcr computed (Cockcroft-Gault) as **{v:.0f} mL/min**")
+            if cr_pct_change is not None:
+                st.markdown(f"• Creatinine change from baseline: **{cr_pct_change:+.0f}%**")
+            if clcr_pct_change is not None:
+                st.markdown(f"• CLcr change from baseline: **{clcr_pct_change:+.0f}%**")
+            elif clcr_mixed_source:
+                st.markdown("• CLcr change from baseline **not computed**: one value measured, one estimated")
+            if cr_uln_multiple is not None:
+                st.markdown(f"• Creatinine **{cr_uln_multiple:.2f}× ULN**")
+            if cr_grading_multiple is not None:
+                st.markdown(f"• CTCAE creatinine grading uses **{cr_grading_multiple:.2f}× {cr_grading_ref}**")
+            if bilirubin_uln_multiple is not None:
+                st.markdown(f"• Bilirubin **{bilirubin_uln_multiple:.2f}× ULN**")
 
         st.markdown("---")
         st.subheader("📋 Dose Modification Recommendations (educational)")
 
         drug_modifications = dose_modifications.get(drug, {})
+        guidance_shown = []
 
         for i, (issue_type, grade_or_condition, details) in enumerate(detected_issues, 1):
             title = f"**{i}. {issue_type}: {grade_or_condition}**"
             with st.expander(title, expanded=True):
                 # LUTATHERA delay special-case
                 if drug == "LUTATHERA" and issue_type == "Dose delayed > 16 weeks":
-                    st.error("⛔ **Dose delay >16 weeks due to toxicity** is a discontinuation criterion in LUTATHERA dose-mod tables.")
+                    delay_guidance = "⛔ **Dose delay >16 weeks due to toxicity** is a discontinuation criterion in LUTATHERA dose-mod tables."
+                    st.error(delay_guidance)
+                    guidance_shown.append((issue_type, grade_or_condition, delay_guidance))
                     st.markdown(f"**Entered delay (weeks):** {details}")
                     continue
 
                 guidance = None
                 if issue_type in drug_modifications:
                     guidance = pick_guidance(drug_modifications[issue_type], grade_or_condition)
+                guidance_shown.append((issue_type, grade_or_condition, guidance))
 
                 if guidance:
                     st.markdown(f"**📝 Recommendation:** {guidance}")
@@ -672,9 +741,48 @@ if st.button("🔍 **Analyze Laboratory Values**", type="primary"):
             "• Reassess prior to each cycle and integrate the patient’s overall condition."
         )
     else:
+        guidance_shown = []
         st.success("✅ **No dose-modification triggers detected** from the values entered (per this tool’s rules).")
         st.info("Continue standard monitoring and reassess before the next cycle.")
 
+    # -------------------------
+    # Audit (enqueue only; written by background thread)
+    # -------------------------
+    try:
+        get_audit_log().record({
+            "patient_id": patient_id_txt.strip() or None,
+            "drug": drug,
+            "rule_pack": RULE_PACK_VERSION,
+            "cbc_units": cbc_units,
+            "inputs": {
+                "hgb": hgb_txt, "plt": plt_txt, "wbc": wbc_txt, "anc": anc_txt,
+                "baseline_cr": baseline_cr_txt, "current_cr": current_cr_txt, "uln_cr": uln_cr_txt,
+                "baseline_clcr": baseline_clcr_txt, "current_clcr": current_clcr_txt,
+                "bilirubin": bili_txt, "uln_bilirubin": uln_bili_txt, "albumin": alb_txt, "inr": inr_txt,
+                "age": age_txt, "weight_kg": weight_txt, "sex": sex,
+                "pluvicto_extras": dict(pluvicto_extras),
+                "lutathera_delay_weeks": lutathera_delay_weeks_txt,
+            },
+            "normalized": {
+                "hemoglobin": hemoglobin, "platelet": platelet, "wbc": wbc, "anc": anc,
+                "baseline_cr": baseline_creatinine, "current_cr": current_creatinine, "uln_cr": uln_creatinine,
+                "baseline_clcr": baseline_clcr, "current_clcr": current_clcr,
+                "bilirubin": bilirubin, "uln_bilirubin": uln_bilirubin, "albumin": albumin, "inr": inr,
+                "cr_ctcae_grade": cr_ctcae_grade,
+                "clcr_computed": clcr_computed,
+                "clcr_mixed_source": clcr_mixed_source,
+                "cr_grading_multiple": cr_grading_multiple, "cr_grading_ref": cr_grading_ref,
+                "cr_pct_change": cr_pct_change, "clcr_pct_change": clcr_pct_change,
+                "cr_uln_multiple": cr_uln_multiple, "bilirubin_uln_multiple": bilirubin_uln_multiple,
+            },
+            "detected_issues": detected_issues,
+            "guidance_shown": guidance_shown,
+        }, timeout=5.0)
+    except AuditRecordsLost as e:
+        st.warning(f"⚠️ Audit log problem: {e}.")
+    except AuditLogError as e:
+        st.error(f"⚠️ Audit log unavailable — this evaluation was NOT recorded ({e}).")
+
 # Footer
 st.markdown("---")
 st.caption("⚠️ Educational tool. Does not replace clinical judgment or official prescribing information.")
@@ -0,0 +1,213 @@
+import gzip
+import json
+import os
+import time
+
+import pytest
+
+import audit_log
+from audit_log import (
+    ACTIVE_NAME, TORN_NAME, AuditLog, AuditLogError, AuditReader, AuditRecordsLost, _sealing_name, shared_log,
+)
+
+
+def _write(directory, entries, **kwargs):
+    log = AuditLog(str(directory), flush_interval=0.01, **kwargs)
+    for e in entries:
+        log.record(e)
+    log.close()
+
+
+def test_rotation_and_patient_history(tmp_path):
+    _write(tmp_path, [{"patient_id": i % 5, "n": i} for i in range(500)], max_bytes=2000)
+
+    reader = AuditReader(str(tmp_path))
+    segments = reader.segments()
+    assert len(segments) > 1
+    for seg in segments:
+        with gzip.open(tmp_path / seg, "rb") as g:
+            assert g.read().endswith(b"\n")
+
+    history = reader.patient_history(3)
+    assert [r["n"] for r in history] == list(range(3, 500, 5))
+    assert all(r["patient_id"] == "3" for r in history)
+    assert reader.patient_history("missing") == []
+
+
+def test_reopen_continues_sequence_and_index(tmp_path):
+    _write(tmp_path, [{"patient_id": "A", "n": i} for i in range(50)], max_bytes=1000)
+    _write(tmp_path, [{"patient_id": "A", "n": i} for i in range(50, 100)], max_bytes=1000)
+
+    history = AuditReader(str(tmp_path)).patient_history("A")
+    assert [r["n"] for r in history] == list(range(100))
+
+
+def test_torn_tail_is_trimmed_before_append(tmp_path):
+    active = tmp_path / ACTIVE_NAME
+    active.write_bytes(b'{"patient_id": "A", "n": 1}\n{"patient_id": "B", "x"')
+
+    _write(tmp_path, [{"patient_id": "C", "n": 2}])
+
+    reader = AuditReader(str(tmp_path))
+    assert [r["n"] for r in reader.patient_history("A")] == [1]
+    assert [r["n"] for r in reader.patient_history("C")] == [2]
+    assert reader.patient_history("B") == []
+    assert (tmp_path / TORN_NAME).read_bytes() == b'{"patient_id": "B", "x"\n'
+
+
+def test_torn_tail_only_fragment(tmp_path):
+    (tmp_path / ACTIVE_NAME).write_bytes(b'{"patient_id": "B"')
+
+    _write(tmp_path, [{"patient_id": "C", "n": 1}])
+
+    assert [r["n"] for r in AuditReader(str(tmp_path)).patient_history("C")] == [1]
+
+
+def test_interrupted_rotation_is_not_sealed_twice(tmp_path):
+    _write(tmp_path, [{"patient_id": "A", "n": i} for i in range(20)], max_bytes=500)
+    segments = AuditReader(str(tmp_path)).segments()
+    last = segments[-1]
+    seq = int(last.split(".")[1])
+
+    # Simulate a crash after the segment was published but before the
+    # sealing file was removed.
+    with gzip.open(tmp_path / last, "rb") as g:
+        (tmp_path / _sealing_name(seq)).write_bytes(g.read())
+
+    _write(tmp_path, [])
+
+    assert AuditReader(str(tmp_path)).segments() == segments
+    assert not os.path.exists(tmp_path / _sealing_name(seq))
+    assert [r["n"] for r in AuditReader(str(tmp_path)).patient_history("A")] == list(range(20))
+
+
+def test_close_returns_when_writer_has_died(tmp_path, monkeypatch):
+    monkeypatch.setattr(AuditLog, "_run", lambda self: os.close(self._lock_fd))
+    log = AuditLog(str(tmp_path), queue_size=1)
+    log._thread.join(2)
+    log._queue.put({"patient_id": "B"})  # queue full, nothing draining it
+
+    start = time.monotonic()
+    log.close()
+    assert time.monotonic() - start < 1
+
+    with pytest.raises(AuditLogError):
+        log.record({"patient_id": "C"})
+
+
+def test_transient_write_failure_is_retried(tmp_path, monkeypatch):
+    real_append = AuditLog._append
+    calls = []
+
+    def flaky(self, entries, lines):
+        calls.append(1)
+        if len(calls) <= 2:
+            self._fh.write(b'{"partial')  # leaves a fragment that must be dropped
+            raise OSError(28, "No space left on device")
+        real_append(self, entries, lines)
+
+    monkeypatch.setattr(AuditLog, "_append", flaky)
+    log = AuditLog(str(tmp_path), flush_interval=0.01, retry_delay=0.001)
+    log.record({"patient_id": "A", "n": 1})
+    log.close()
+
+    assert len(calls) == 3
+    assert (tmp_path / ACTIVE_NAME).read_bytes().count(b"\n") == 1
+    assert [r["n"] for r in AuditReader(str(tmp_path)).patient_history("A")] == [1]
+
+
+def test_persistent_write_failure_spills_and_writer_keeps_running(tmp_path, monkeypatch):
+    def broken(self, entries, lines):
+        raise OSError(5, "Input/output error")
+
+    monkeypatch.setattr(AuditLog, "_append", broken)
+    log = AuditLog(str(tmp_path), flush_interval=0.01, write_retries=1, retry_delay=0.001)
+    log.record({"patient_id": "A", "n": 1})
+    log.record({"patient_id": "A", "n": 2})
+    time.sleep(0.2)
+    assert log.healthy()
+    log.close()
+
+    assert [r["n"] for r in AuditReader(str(tmp_path)).patient_history("A")] == [1, 2]
+
+
+def test_lost_records_are_reported_on_next_record(tmp_path, monkeypatch):
+    def broken(self, *args):
+        raise OSError(5, "Input/output error")
+
+    monkeypatch.setattr(AuditLog, "_append", broken)
+    log = AuditLog(str(tmp_path), flush_interval=0.01, write_retries=0)
+    monkeypatch.setattr(audit_log, "open", broken, raising=False)  # spill fails too
+    log.record({"patient_id": "A"})
+    deadline = time.monotonic() + 2
+    while log._lost == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    with pytest.raises(AuditRecordsLost, match="1 earlier"):
+        log.record({"patient_id": "B"})
+    monkeypatch.undo()
+    log.close()
+
+
+def test_second_writer_on_same_directory_is_refused(tmp_path):
+    log = AuditLog(str(tmp_path))
+    try:
+        with pytest.raises(AuditLogError, match="another audit writer"):
+            AuditLog(str(tmp_path))
+    finally:
+        log.close()
+    AuditLog(str(tmp_path)).close()  # lock released on close
+
+
+def test_shared_log_replaces_stopped_writer(tmp_path):
+    first = shared_log(str(tmp_path))
+    assert shared_log(str(tmp_path)) is first
+    first.close()
+
+    second = shared_log(str(tmp_path))
+    assert second is not first and second.healthy()
+    second.close()
+
+
+def test_stale_sealing_file_is_read_directly(tmp_path):
+    _write(tmp_path, [{"patient_id": "A", "n": 1}])
+    (tmp_path / _sealing_name(7)).write_bytes(b'{"patient_id": "A", "n": 0, "ts": 0}\n')
+
+    start = time.monotonic()
+    history = AuditReader(str(tmp_path)).patient_history("A")
+    assert time.monotonic() - start < 0.5
+    assert [r["n"] for r in history] == [0, 1]
+
+
+def test_index_offset_for_other_patient_is_skipped(tmp_path):
+    _write(tmp_path, [{"patient_id": p, "n": i} for i, p in enumerate("ABAB" * 10)], max_bytes=300)
+    seg = AuditReader(str(tmp_path)).segments()[0]
+    idx_path = tmp_path / (seg + ".idx.json")
+    idx = json.loads(idx_path.read_text())
+    idx["A"] = sorted(idx["A"] + idx["B"])  # stale/mixed offsets
+    idx_path.write_text(json.dumps(idx))
+
+    history = AuditReader(str(tmp_path)).patient_history("A")
+    assert history and all(r["patient_id"] == "A" for r in history)
+
+
+def test_lookup_only_opens_segments_mentioning_patient(tmp_path):
+    _write(tmp_path, [{"patient_id": "A", "n": i} for i in range(10)], max_bytes=200)
+    a_segments = AuditReader(str(tmp_path)).segments()
+    _write(tmp_path, [{"patient_id": "B", "n": i} for i in range(10)], max_bytes=200)
+    for seg in AuditReader(str(tmp_path)).segments():
+        if seg not in a_segments:
+            (tmp_path / (seg + ".idx.json")).write_text("not json")
+
+    assert [r["n"] for r in AuditReader(str(tmp_path)).patient_history("A")] == list(range(10))
+
+
+def test_sealing_file_left_by_crash_is_sealed_on_open(tmp_path):
+    (tmp_path / _sealing_name(1)).write_bytes(b'{"patient_id": "A", "n": 1}\n')
+    (tmp_path / ACTIVE_NAME).write_bytes(b'{"patient_id": "A", "n": 2}\n')
+
+    _write(tmp_path, [{"patient_id": "A", "n": 3}])
+
+    reader = AuditReader(str(tmp_path))
+    assert reader.segments() == ["audit.000001.jsonl.gz"]
+    assert [r["n"] for r in reader.patient_history("A")] == [1, 2, 3]
@@ -0,0 +1,131 @@
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from derived_values import (
+    check_sex_labels, cockcroft_gault, derive_inputs, enrich_csv, female_mask, pct_change, uln_multiple,
+)
+
+
+def test_cockcroft_gault_male_and_female():
+    # (140 - 60) * 72 / (72 * 1.0) = 80; female x 0.85 = 68
+    clcr = cockcroft_gault([1.0, 1.0], [60, 60], [72, 72], [0.0, 1.0])
+    assert clcr == pytest.approx([80.0, 68.0])
+
+
+@pytest.mark.parametrize("cr, age, weight, female", [
+    (0.0, 60, 70, 0.0),       # non-positive creatinine
+    (-1.0, 60, 70, 0.0),
+    (1.0, 150, 70, 0.0),      # age >= 140 would give negative CLcr
+    (1.0, 140, 70, 0.0),      # result would be 0
+    (1.0, 10, 70, 0.0),       # below plausible adult range
+    (1.0, 60, -70, 0.0),      # non-positive weight
+    (1.0, 60, 0, 0.0),
+    (1.0, 60, 70, np.nan),    # unknown sex
+    (np.nan, 60, 70, 0.0),
+])
+def test_cockcroft_gault_implausible_inputs_are_nan(cr, age, weight, female):
+    assert math.isnan(cockcroft_gault([cr], [age], [weight], [female])[0])
+
+
+def test_female_mask():
+    out = female_mask([" Female", "m", "MALE", "x", "", "nan"])
+    assert out[:3].tolist() == [1.0, 0.0, 0.0]
+    assert np.isnan(out[3:]).all()
+
+
+def test_pct_change_and_uln_multiple_exact_thresholds():
+    assert pct_change([1.0, 85.0, 0.0], [1.4, 51.0, 1.0])[:2].tolist() == [40.0, -40.0]
+    assert math.isnan(pct_change([0.0], [1.0])[0])
+    assert uln_multiple([3.3, 1.0], [1.1, 0.0])[0] == 3.0
+    assert math.isnan(uln_multiple([1.0], [0.0])[0])
+
+
+def test_derive_inputs_fills_only_missing_clcr():
+    cols = derive_inputs({
+        "baseline_cr": [1.0, 1.0], "current_cr": [1.5, 1.5], "uln_cr": [1.2, 1.2],
+        "baseline_clcr": [None, 90.0], "current_clcr": [50.0, None],
+        "bilirubin": [3.5, None], "uln_bilirubin": [1.0, 1.0],
+        "age": [60, 60], "weight_kg": [72, 72], "sex": ["F", "M"],
+    })
+    assert cols["baseline_clcr"].tolist() == pytest.approx([68.0, 90.0])
+    assert cols["current_clcr"].tolist() == pytest.approx([50.0, 80.0 / 1.5])
+    assert cols["cr_pct_change"].tolist() == pytest.approx([50.0, 50.0])
+    assert cols["cr_uln_multiple"].tolist() == pytest.approx([1.25, 1.25])
+    assert cols["bilirubin_uln_multiple"][0] == 3.5
+    assert math.isnan(cols["bilirubin_uln_multiple"][1])
+
+
+def test_derive_inputs_treats_bad_cells_as_missing():
+    cols = derive_inputs({"current_cr": ["<0.2", "1.0", None], "age": [60, 60, 60],
+                          "weight_kg": [72, 72, 72], "sex": ["M", "M", "M"]})
+    clcr = cols["current_clcr"]
+    assert math.isnan(clcr[0]) and math.isnan(clcr[2])
+    assert clcr[1] == pytest.approx(80.0)
+
+
+def test_enrich_csv_survives_non_numeric_cells(tmp_path):
+    src, dst = tmp_path / "in.csv", tmp_path / "out.csv"
+    pd.DataFrame({
+        "current_cr": ["1.0", "<0.2", "2.0"],
+        "age": [60, 60, 60], "weight_kg": [72, 72, 72], "sex": ["M", "F", "M"],
+    }).to_csv(src, index=False)
+
+    enrich_csv(src, dst, chunksize=2)
+
+    out = pd.read_csv(dst)
+    assert len(out) == 3
+    assert out["current_clcr"][0] == pytest.approx(80.0)
+    assert math.isnan(out["current_clcr"][1])
+    assert out["current_clcr"][2] == pytest.approx(40.0)
+
+
+def test_clcr_pct_change_requires_same_source():
+    cols = derive_inputs({
+        "baseline_cr": [1.0, 1.0, 1.0], "current_cr": [2.0, 2.0, 2.0],
+        "baseline_clcr": [85.0, None, 85.0], "current_clcr": [None, None, 40.0],
+        "age": [60, 60, 60], "weight_kg": [72, 72, 72], "sex": ["M", "M", "M"],
+    })
+    assert cols["baseline_clcr_estimated"].tolist() == [False, True, False]
+    assert cols["current_clcr_estimated"].tolist() == [True, True, False]
+    assert math.isnan(cols["clcr_pct_change"][0])       # measured vs estimated
+    assert cols["clcr_pct_change"][1] == pytest.approx(-50.0)
+    assert cols["clcr_pct_change"][2] == pytest.approx(-52.941176, rel=1e-6)
+
+
+def test_cr_grading_multiple_uses_baseline_when_above_uln():
+    cols = derive_inputs({
+        "baseline_cr": [1.0, 2.0, None, 2.0], "current_cr": [1.8, 3.5, 1.8, 3.5],
+        "uln_cr": [1.2, 1.2, 1.2, 0.0],
+    })
+    assert cols["cr_graded_vs_baseline"].tolist() == [False, True, False, False]
+    assert cols["cr_grading_multiple"][:3].tolist() == [1.5, 1.75, 1.5]
+    assert math.isnan(cols["cr_grading_multiple"][3])
+
+
+def test_check_sex_labels():
+    assert check_sex_labels(["F", "m", None, " "]) == []
+    assert check_sex_labels(["F", "W", "M"]) == ["W"]
+    with pytest.raises(ValueError, match="no recognised values"):
+        check_sex_labels([1, 2, 1])
+
+
+def test_enrich_csv_rejects_unrecognised_sex_coding(tmp_path):
+    src, dst = tmp_path / "in.csv", tmp_path / "out.csv"
+    pd.DataFrame({"current_cr": [1.0, 1.0], "age": [60, 60], "weight_kg": [72, 72],
+                  "sex": [1, 2]}).to_csv(src, index=False)
+
+    with pytest.raises(ValueError, match="no recognised values"):
+        enrich_csv(src, dst)
+
+
+def test_enrich_csv_warns_on_partly_unrecognised_sex(tmp_path):
+    src, dst = tmp_path / "in.csv", tmp_path / "out.csv"
+    pd.DataFrame({"current_cr": [1.0, 1.0], "age": [60, 60], "weight_kg": [72, 72],
+                  "sex": ["M", "W"]}).to_csv(src, index=False)
+
+    with pytest.warns(UserWarning, match="W"):
+        enrich_csv(src, dst)
+    assert pd.read_csv(dst)["current_clcr"][0] == pytest.approx(80.0)